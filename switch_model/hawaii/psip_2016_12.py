@@ -1,6 +1,7 @@
 from __future__ import division
 from __future__ import print_function
 from collections import defaultdict
+import bisect
 from textwrap import dedent
 import os
 from pyomo.environ import *
@@ -25,6 +26,14 @@ def is_renewable(tech):
 def is_battery(tech):
     return 'battery' in tech.lower()
 
+def restrict_to_zero(var):
+    """Hold all elements of a Pyomo Var (indexed or not) at zero.
+    This sets bounds instead of fixing the variables, so modules that fix and
+    unfix variables (e.g., smooth_dispatch) can't undo it."""
+    for v in var.values():
+        v.setlb(0)
+        v.setub(0)
+
 def define_components(m):
     ###################
     # resource rules to match HECO's 2016-04-01 PSIP
@@ -107,10 +116,8 @@ def define_components(m):
 
     # add targets specified on the command line
     if m.options.force_build is not None:
-        b = list(m.options.force_build)
-        b[0] = int(b[0])    # year
-        b[2] = float(b[2])  # quantity
-        b = tuple(b)
+        year, tech, quantity = m.options.force_build
+        b = (int(year), tech, float(quantity))
         print("Forcing build: {}".format(b))
         technology_targets_definite.append(b)
 
@@ -222,15 +229,19 @@ def define_components(m):
     ]
     existing_techs += technology_targets_definite
     existing_techs += technology_targets_psip
-    # rebuild all renewables at retirement (20 years for RE, 15 years for batteries)
-    rebuild_targets = [
-        (y+20, tech, cap) for y, tech, cap in existing_techs if is_renewable(tech)
-    ] + [
-        (y+15, tech, cap) for y, tech, cap in existing_techs if is_battery(tech)
-    ] # note: early batteries won't quite need 2 replacements
-    # don't schedule rebuilding past end of study
-    rebuild_targets = [t for t in rebuild_targets if t[0] <= 2045]
-    technology_targets_psip += rebuild_targets
+    # rebuild all renewables at retirement (20 years for RE, 15 years for batteries),
+    # but don't schedule rebuilding past end of study
+    # note: early batteries won't quite need 2 replacements
+    # (classify each technology once, rather than once per target)
+    existing_tech_names = set(tech for y, tech, cap in existing_techs)
+    renewable_techs = set(t for t in existing_tech_names if is_renewable(t))
+    battery_techs = set(t for t in existing_tech_names if is_battery(t))
+    technology_targets_psip.extend(
+        (y + life, tech, cap)
+        for life, rebuild_techs in [(20, renewable_techs), (15, battery_techs)]
+            for y, tech, cap in existing_techs
+                if tech in rebuild_techs and y + life <= 2045
+    )
 
     # make sure LNG is turned off
     if psip and getattr(m.options, "force_lng_tier", []) != ["none"]:
@@ -254,35 +265,72 @@ def define_components(m):
         filter=lambda m, tech: is_renewable(tech)
     )
 
-    def technology_target_init(m, per, tech):
+    def MakeTechnologyTargetDict_rule(m):
         """Find the amount of each technology that is targeted to be built between the start of the
         previous period and the start of the current period."""
-        start = 2000 if per == m.PERIODS.first() else m.PERIODS.prev(per)
-        end = per
-        target = sum(
-            mw for (tyear, ttech, mw) in technology_targets
-                if ttech == tech and start < tyear and tyear <= end
-        )
-        return target
-    m.technology_target = Param(m.PERIODS, m.GEN_TECHS_AND_BATTERIES, initialize=technology_target_init)
+        # assign each target to its period in a single pass through the list
+        # (adding in list order, so the totals match a direct sum)
+        periods = list(m.PERIODS)
+        target_dict = m.technology_target_dict = defaultdict(float)
+        for (tyear, tech, mw) in technology_targets:
+            if tech not in m.GEN_TECHS_AND_BATTERIES:
+                # not available in this model; technology_target can't hold it
+                continue
+            # first period starting in or after tyear
+            i = bisect.bisect_left(periods, tyear)
+            if i == len(periods):
+                continue    # after the start of the last period
+            # targets before the first period are counted from 2000
+            prev_per = 2000 if i == 0 else periods[i-1]
+            if tyear > prev_per:
+                target_dict[periods[i], tech] += mw
+    m.MakeTechnologyTargetDict = BuildAction(rule=MakeTechnologyTargetDict_rule)
+
+    # load all the targets at once; periods and technologies without a target default to zero
+    m.technology_target = Param(
+        m.PERIODS, m.GEN_TECHS_AND_BATTERIES, default=0.0,
+        initialize=lambda m: dict(m.technology_target_dict)
+    )
 
     def MakeGenTechDicts_rule(m):
+        # copy technology of each project into a plain dict, to avoid
+        # Pyomo's indexing overhead inside the loops below
+        gen_tech = dict(m.gen_tech.items())
         # get unit sizes of all technologies
-        unit_sizes = m.gen_tech_unit_size_dict = defaultdict(float)
+        tech_unit_sizes = defaultdict(set)
         for g, unit_size in m.gen_unit_size.items():
-            tech = m.gen_tech[g]
-            if tech in unit_sizes:
-                if unit_sizes[tech] != unit_size:
-                    raise ValueError("Generation technology {} uses different unit sizes for different projects.")
-            else:
-                unit_sizes[tech] = unit_size
+            tech_unit_sizes[gen_tech[g]].add(unit_size)
+        unit_sizes = m.gen_tech_unit_size_dict = defaultdict(float)
+        for tech, sizes in tech_unit_sizes.items():
+            if len(sizes) > 1:
+                raise ValueError(
+                    "Generation technology {} uses different unit sizes for different projects: {}."
+                    .format(tech, sorted(sizes))
+                )
+            unit_sizes[tech] = sizes.pop()
         # get predetermined capacity for all technologies
         predet_cap = m.gen_tech_predetermined_cap_dict = defaultdict(float)
         for (g, per), cap in m.gen_predetermined_cap.items():
-            tech = m.gen_tech[g]
-            predet_cap[tech, per] += cap
+            predet_cap[gen_tech[g], per] += cap
+        # get the projects that can be built for each technology in each period
+        gens_by_tech_period = m.gens_by_tech_period_dict = defaultdict(list)
+        for (g, per) in m.GEN_BLD_YRS:
+            gens_by_tech_period[gen_tech[g], per].append(g)
+        # plain set of renewable technologies, for fast membership tests
+        # in Enforce_Technology_Target_rule
+        m.renewable_technologies_set = frozenset(m.RENEWABLE_TECHNOLOGIES)
     m.MakeGenTechDicts = BuildAction(rule=MakeGenTechDicts_rule)
 
+    # decide which periods should follow the PSIP plan exactly; this only depends
+    # on the options, so we do it once here rather than in every rule call
+    if not psip:
+        psip_exact_target_end = float('-inf')   # no periods
+    elif m.options.psip_relax_after is None:
+        psip_exact_target_end = float('inf')    # all periods
+    else:
+        psip_exact_target_end = m.options.psip_relax_after
+    psip_minimal_renewables = m.options.psip_minimal_renewables
+
     # with PSIP: BuildGen is zero except for technology_targets
     #     (sum during each period or before first period)
     # without PSIP: BuildGen is >= definite targets
@@ -291,28 +339,30 @@ def define_components(m):
 
         # get target, including any capacity specified in the predetermined builds,
         # so the target will be additional to those
-        target = m.technology_target[per, tech] + m.gen_tech_predetermined_cap_dict[tech, per]
+        # (technology_target is read from the dict it was built from, to avoid
+        # Pyomo's Param indexing overhead)
+        target = (
+            m.technology_target_dict.get((per, tech), 0.0)
+            + m.gen_tech_predetermined_cap_dict[tech, per]
+        )
 
         # convert target to closest integral number of units
         # (some of the targets are based on nominal unit sizes rather than actual max output)
-        if m.gen_tech_unit_size_dict[tech] > 0.0:
-            target = round(target / m.gen_tech_unit_size_dict[tech]) * m.gen_tech_unit_size_dict[tech]
+        unit_size = m.gen_tech_unit_size_dict[tech]
+        if unit_size > 0.0:
+            target = round(target / unit_size) * unit_size
 
+        # find out whether anything can be built for this technology in this period,
+        # before constructing the expression
         if tech == "LoadShiftBattery":
             # special treatment for batteries, which are not a standard technology
-            if hasattr(m, 'BuildBattery'):
-                # note: BuildBattery is in MWh, so we convert to MW
-                build = sum(m.BuildBattery[z, per] for z in m.LOAD_ZONES) / m.battery_min_discharge_time
-            else:
-                build = 0
+            gens = None
+            have_projects = hasattr(m, 'BuildBattery')
         else:
-            build = sum(
-                m.BuildGen[g, per]
-                for g in m.GENERATION_PROJECTS
-                if m.gen_tech[g] == tech and (g, per) in m.GEN_BLD_YRS
-            )
+            gens = m.gens_by_tech_period_dict.get((tech, per), [])
+            have_projects = bool(gens)
 
-        if type(build) is int and build == 0:
+        if not have_projects:
             # no matching projects found
             if target == 0:
                 return Constraint.Skip
@@ -322,9 +372,17 @@ def define_components(m):
                     "Model will be infeasible.".format(tech, per)
                 )
                 return Constraint.Infeasible
-        elif psip and per <= m.options.psip_relax_after:
+
+        if gens is None:
+            # note: BuildBattery is in MWh, so we convert to MW
+            build = sum(m.BuildBattery[z, per] for z in m.LOAD_ZONES) / m.battery_min_discharge_time
+        else:
+            # quicksum builds one sum expression instead of a nested chain of pairwise sums
+            build = quicksum(m.BuildGen[g, per] for g in gens)
+
+        if per <= psip_exact_target_end:
             return (build == target)
-        elif m.options.psip_minimal_renewables and tech in m.RENEWABLE_TECHNOLOGIES:
+        elif psip_minimal_renewables and tech in m.renewable_technologies_set:
             # only build the specified amount of renewables, no more
             return (build == target)
         else:
@@ -426,19 +484,19 @@ def define_components(m):
         # )
 
         # don't allow construction of other technologies (e.g., pumped hydro, fuel cells)
+        # note: we bound these variables at zero (see restrict_to_zero) instead of
+        # adding a constraint row for every index
         advanced_tech_vars = [
             "BuildPumpedHydroMW", "BuildAnyPumpedHydro",
             "BuildElectrolyzerMW", "BuildLiquifierKgPerHour", "BuildLiquidHydrogenTankKg",
             "BuildFuelCellMW",
         ]
-        def no_advanced_tech_rule_factory(v):
-            return lambda m, *k: (getattr(m, v)[k] == 0)
-        for v in advanced_tech_vars:
-            try:
-                var = getattr(m, v)
-                setattr(m, "PSIP_No_"+v, Constraint(var._index, rule=no_advanced_tech_rule_factory(v)))
-            except AttributeError:
-                pass    # model doesn't have this var
+        # skip any vars the model doesn't have
+        advanced_tech_vars = [v for v in advanced_tech_vars if hasattr(m, v)]
+        def PSIP_No_Advanced_Techs_rule(m):
+            for v in advanced_tech_vars:
+                restrict_to_zero(getattr(m, v))
+        m.PSIP_No_Advanced_Techs = BuildAction(rule=PSIP_No_Advanced_Techs_rule)
 
         # # don't allow any changes to the fuel market, including bulk LNG
         # # not used now; use "--force-lng-tier container" instead